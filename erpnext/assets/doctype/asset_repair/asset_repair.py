@@ -3,14 +3,13 @@
 
 import frappe
 from frappe import _
-from frappe.utils import add_months, cint, flt, get_link_to_form, getdate, time_diff_in_hours
+from frappe.utils import add_months, cint, flt, get_datetime, get_link_to_form, getdate
 
 import erpnext
 from erpnext.accounts.general_ledger import make_gl_entries
 from erpnext.assets.doctype.asset.asset import get_asset_account
 from erpnext.assets.doctype.asset_depreciation_schedule.asset_depreciation_schedule import (
 	get_asset_depr_schedule_doc,
-	get_depr_schedule,
 	make_new_active_asset_depr_schedules_and_cancel_current_ones,
 )
 from erpnext.controllers.accounts_controller import AccountsController
@@ -18,13 +17,19 @@ from erpnext.controllers.accounts_controller import AccountsController
 
 class AssetRepair(AccountsController):
 	def validate(self):
-		self.asset_doc = frappe.get_doc("Asset", self.asset)
+		self.set_asset_doc()
 		self.update_status()
 
 		if self.get("stock_items"):
 			self.set_stock_items_cost()
 		self.calculate_total_repair_cost()
 
+	def set_asset_doc(self):
+		# fetch the Asset only once per request, even if multiple
+		# controller hooks need it
+		if not self.get("asset_doc") or self.asset_doc.name != self.asset:
+			self.asset_doc = frappe.get_doc("Asset", self.asset)
+
 	def update_status(self):
 		if self.repair_status == "Pending":
 			frappe.db.set_value("Asset", self.asset, "status", "Out of Order")
@@ -32,14 +37,18 @@ class AssetRepair(AccountsController):
 			self.asset_doc.set_status()
 
 	def set_stock_items_cost(self):
+		_flt = flt  # avoid a global lookup per row
 		for item in self.get("stock_items"):
-			item.total_value = flt(item.valuation_rate) * flt(item.consumed_quantity)
+			item.total_value = _flt(item.valuation_rate) * _flt(item.consumed_quantity)
+
+		# item values have changed, so the cached total is stale
+		self._total_value_of_stock_consumed = None
 
 	def calculate_total_repair_cost(self):
 		self.total_repair_cost = flt(self.repair_cost)
 
-		total_value_of_stock_consumed = self.get_total_value_of_stock_consumed()
-		self.total_repair_cost += total_value_of_stock_consumed
+		if self.get("stock_consumption"):
+			self.total_repair_cost += self.get_total_value_of_stock_consumed()
 
 	def before_submit(self):
 		self.check_repair_status()
@@ -59,20 +68,24 @@ class AssetRepair(AccountsController):
 				if self.asset_doc.calculate_depreciation and self.increase_in_asset_life:
 					self.modify_depreciation_schedule()
 
-			notes = _(
-				"This schedule was created when Asset {0} was repaired through Asset Repair {1}."
-			).format(
-				get_link_to_form(self.asset_doc.doctype, self.asset_doc.name),
-				get_link_to_form(self.doctype, self.name),
-			)
 			self.asset_doc.flags.ignore_validate_update_after_submit = True
-			make_new_active_asset_depr_schedules_and_cancel_current_ones(self.asset_doc, notes)
+
 			if self.asset_doc.calculate_depreciation:
+				notes = _(
+					"This schedule was created when Asset {0} was repaired through Asset Repair {1}."
+				).format(
+					get_link_to_form(self.asset_doc.doctype, self.asset_doc.name),
+					get_link_to_form(self.doctype, self.name),
+				)
+				make_new_active_asset_depr_schedules_and_cancel_current_ones(self.asset_doc, notes)
+				# the Active schedules have just been replaced
+				self._depr_schedule_docs = {}
 				self.update_asset_expected_value_after_useful_life()
+
 			self.asset_doc.save()
 
 	def before_cancel(self):
-		self.asset_doc = frappe.get_doc("Asset", self.asset)
+		self.set_asset_doc()
 
 		self.asset_doc.flags.increase_in_asset_value_due_to_repair = False
 
@@ -86,20 +99,30 @@ class AssetRepair(AccountsController):
 			if self.get("capitalize_repair_cost"):
 				self.ignore_linked_doctypes = ("GL Entry", "Stock Ledger Entry")
 				self.make_gl_entries(cancel=True)
-				self.db_set("stock_entry", None)
 				if self.asset_doc.calculate_depreciation and self.increase_in_asset_life:
 					self.revert_depreciation_schedule_on_cancellation()
 
-			notes = _("This schedule was created when Asset {0}'s Asset Repair {1} was cancelled.").format(
-				get_link_to_form(self.asset_doc.doctype, self.asset_doc.name),
-				get_link_to_form(self.doctype, self.name),
-			)
 			self.asset_doc.flags.ignore_validate_update_after_submit = True
-			make_new_active_asset_depr_schedules_and_cancel_current_ones(self.asset_doc, notes)
+
 			if self.asset_doc.calculate_depreciation:
+				notes = _(
+					"This schedule was created when Asset {0}'s Asset Repair {1} was cancelled."
+				).format(
+					get_link_to_form(self.asset_doc.doctype, self.asset_doc.name),
+					get_link_to_form(self.doctype, self.name),
+				)
+				make_new_active_asset_depr_schedules_and_cancel_current_ones(self.asset_doc, notes)
+				# the Active schedules have just been replaced
+				self._depr_schedule_docs = {}
 				self.update_asset_expected_value_after_useful_life()
+
 			self.asset_doc.save()
 
+			if self.get("capitalize_repair_cost"):
+				# cleared last so the GL reversal above can still read the
+				# link, and written in a single UPDATE after the asset save
+				self.db_set("stock_entry", None, update_modified=False)
+
 	def after_delete(self):
 		frappe.get_doc("Asset", self.asset).set_status()
 
@@ -108,35 +131,55 @@ class AssetRepair(AccountsController):
 			frappe.throw(_("Please update Repair Status."))
 
 	def check_for_stock_items_and_warehouse(self):
+		# happy path first: no translated strings are built on every submit
+		if self.get("stock_items") and self.warehouse:
+			return
+
 		if not self.get("stock_items"):
 			frappe.throw(
 				_("Please enter Stock Items consumed during the Repair."), title=_("Missing Items")
 			)
-		if not self.warehouse:
-			frappe.throw(
-				_("Please enter Warehouse from which Stock Items consumed during the Repair were taken."),
-				title=_("Missing Warehouse"),
+
+		frappe.throw(
+			_("Please enter Warehouse from which Stock Items consumed during the Repair were taken."),
+			title=_("Missing Warehouse"),
+		)
+
+	def get_active_depr_schedule_doc(self, finance_book=None):
+		# the same (asset, finance_book) schedule is needed by multiple
+		# methods within one submit/cancel, so fetch it only once
+		if self.get("_depr_schedule_docs") is None:
+			self._depr_schedule_docs = {}
+
+		if finance_book not in self._depr_schedule_docs:
+			self._depr_schedule_docs[finance_book] = get_asset_depr_schedule_doc(
+				self.asset_doc.name, "Active", finance_book
 			)
 
+		return self._depr_schedule_docs[finance_book]
+
 	def update_asset_expected_value_after_useful_life(self):
-		for row in self.asset_doc.get("finance_books"):
-			if row.depreciation_method in ("Written Down Value", "Double Declining Balance"):
-				asset_depr_schedule_doc = get_asset_depr_schedule_doc(
-					self.asset_doc.name, "Active", row.finance_book
-				)
+		finance_books = self.asset_doc.get("finance_books")
+		if not finance_books:
+			return
 
-				accumulated_depreciation_after_full_schedule = [
-					d.accumulated_depreciation_amount
-					for d in asset_depr_schedule_doc.get("depreciation_schedule")
-				]
+		precision = finance_books[0].precision("expected_value_after_useful_life")
+
+		for row in finance_books:
+			if row.depreciation_method in ("Written Down Value", "Double Declining Balance"):
+				asset_depr_schedule_doc = self.get_active_depr_schedule_doc(row.finance_book)
 
 				accumulated_depreciation_after_full_schedule = max(
-					accumulated_depreciation_after_full_schedule
+					(
+						d.accumulated_depreciation_amount
+						for d in asset_depr_schedule_doc.get("depreciation_schedule")
+					),
+					default=0,
 				)
 
 				asset_value_after_full_schedule = flt(
 					flt(row.value_after_depreciation) - flt(accumulated_depreciation_after_full_schedule),
-					row.precision("expected_value_after_useful_life"),
+					precision,
 				)
 
 				row.expected_value_after_useful_life = asset_value_after_full_schedule
@@ -145,62 +188,78 @@ class AssetRepair(AccountsController):
 				)
 
 	def increase_asset_value(self):
-		total_value_of_stock_consumed = self.get_total_value_of_stock_consumed()
+		if not self.asset_doc.calculate_depreciation:
+			return
 
-		if self.asset_doc.calculate_depreciation:
-			for row in self.asset_doc.finance_books:
-				row.value_after_depreciation += total_value_of_stock_consumed
+		change_in_value = self.get_total_value_of_stock_consumed()
+		if self.capitalize_repair_cost:
+			change_in_value += self.repair_cost
 
-				if self.capitalize_repair_cost:
-					row.value_after_depreciation += self.repair_cost
+		for row in self.asset_doc.finance_books:
+			row.value_after_depreciation += change_in_value
 
 	def decrease_asset_value(self):
-		total_value_of_stock_consumed = self.get_total_value_of_stock_consumed()
+		if not self.asset_doc.calculate_depreciation:
+			return
 
-		if self.asset_doc.calculate_depreciation:
-			for row in self.asset_doc.finance_books:
-				row.value_after_depreciation -= total_value_of_stock_consumed
+		change_in_value = self.get_total_value_of_stock_consumed()
+		if self.capitalize_repair_cost:
+			change_in_value += self.repair_cost
 
-				if self.capitalize_repair_cost:
-					row.value_after_depreciation -= self.repair_cost
+		for row in self.asset_doc.finance_books:
+			row.value_after_depreciation -= change_in_value
 
 	def get_total_value_of_stock_consumed(self):
-		total_value_of_stock_consumed = 0
-		if self.get("stock_consumption"):
-			for item in self.get("stock_items"):
-				total_value_of_stock_consumed += item.total_value
+		# computed once and reused by calculate_total_repair_cost,
+		# increase_asset_value and decrease_asset_value
+		if self.get("_total_value_of_stock_consumed") is None:
+			total_value_of_stock_consumed = 0
+			if self.get("stock_consumption"):
+				for item in self.get("stock_items"):
+					total_value_of_stock_consumed += item.total_value
+
+			self._total_value_of_stock_consumed = total_value_of_stock_consumed
 
-		return total_value_of_stock_consumed
+		return self._total_value_of_stock_consumed
 
 	def decrease_stock_quantity(self):
 		stock_entry = frappe.get_doc(
-			{"doctype": "Stock Entry", "stock_entry_type": "Material Issue", "company": self.company}
+			{
+				"doctype": "Stock Entry",
+				"stock_entry_type": "Material Issue",
+				"company": self.company,
+				"items": [
+					{
+						"s_warehouse": self.warehouse,
+						"item_code": stock_item.item_code,
+						"qty": stock_item.consumed_quantity,
+						"basic_rate": stock_item.valuation_rate,
+						"serial_no": stock_item.serial_no,
+						"cost_center": self.cost_center,
+						"project": self.project,
+					}
+					for stock_item in self.get("stock_items")
+				],
+			}
 		)
 
-		for stock_item in self.get("stock_items"):
-			stock_entry.append(
-				"items",
-				{
-					"s_warehouse": self.warehouse,
-					"item_code": stock_item.item_code,
-					"qty": stock_item.consumed_quantity,
-					"basic_rate": stock_item.valuation_rate,
-					"serial_no": stock_item.serial_no,
-					"cost_center": self.cost_center,
-					"project": self.project,
-				},
-			)
-
 		stock_entry.insert()
 		stock_entry.submit()
 
 		self.db_set("stock_entry", stock_entry.name)
 
 	def increase_stock_quantity(self):
-		if self.stock_entry:
-			stock_entry = frappe.get_doc("Stock Entry", self.stock_entry)
-			stock_entry.flags.ignore_links = True
-			stock_entry.cancel()
+		if not self.stock_entry:
+			return
+
+		# check docstatus first to avoid hydrating the full Stock Entry
+		# when there is nothing to cancel
+		if frappe.db.get_value("Stock Entry", self.stock_entry, "docstatus") != 1:
+			return
+
+		stock_entry = frappe.get_doc("Stock Entry", self.stock_entry)
+		stock_entry.flags.ignore_links = True
+		stock_entry.cancel()
 
 	def make_gl_entries(self, cancel=False):
 		if flt(self.total_repair_cost) > 0:
@@ -210,36 +269,45 @@ class AssetRepair(AccountsController):
 	def get_gl_entries(self):
 		gl_entries = []
 
-		fixed_asset_account = get_asset_account(
-			"fixed_asset_account", asset=self.asset, company=self.company
-		)
+		fixed_asset_account = self.get_fixed_asset_account()
 		self.get_gl_entries_for_repair_cost(gl_entries, fixed_asset_account)
 		self.get_gl_entries_for_consumed_items(gl_entries, fixed_asset_account)
 
 		return gl_entries
 
+	def get_fixed_asset_account(self):
+		# get_asset_account walks Asset Category and Company settings,
+		# so resolve it only once per lifecycle
+		if not self.get("_fixed_asset_account"):
+			self._fixed_asset_account = get_asset_account(
+				"fixed_asset_account", asset=self.asset, company=self.company
+			)
+
+		return self._fixed_asset_account
+
 	def get_gl_entries_for_repair_cost(self, gl_entries, fixed_asset_account):
 		if flt(self.repair_cost) <= 0:
 			return
 
-		pi_expense_account = (
-			frappe.get_doc("Purchase Invoice", self.purchase_invoice).items[0].expense_account
+		pi_expense_account = frappe.db.get_value(
+			"Purchase Invoice Item",
+			{"parent": self.purchase_invoice},
+			"expense_account",
+			order_by="idx asc",
 		)
 
+		base_gl_entry = self.get_base_gl_entry_fields()
+
 		gl_entries.append(
 			self.get_gl_dict(
 				{
+					**base_gl_entry,
 					"account": fixed_asset_account,
 					"debit": self.repair_cost,
 					"debit_in_account_currency": self.repair_cost,
 					"against": pi_expense_account,
-					"voucher_type": self.doctype,
-					"voucher_no": self.name,
-					"cost_center": self.cost_center,
-					"posting_date": getdate(),
 					"against_voucher_type": "Purchase Invoice",
 					"against_voucher": self.purchase_invoice,
-					"company": self.company,
 				},
 				item=self,
 			)
@@ -248,26 +316,38 @@ class AssetRepair(AccountsController):
 		gl_entries.append(
 			self.get_gl_dict(
 				{
+					**base_gl_entry,
 					"account": pi_expense_account,
 					"credit": self.repair_cost,
 					"credit_in_account_currency": self.repair_cost,
 					"against": fixed_asset_account,
-					"voucher_type": self.doctype,
-					"voucher_no": self.name,
-					"cost_center": self.cost_center,
-					"posting_date": getdate(),
-					"company": self.company,
 				},
 				item=self,
 			)
 		)
 
+	def get_base_gl_entry_fields(self):
+		# fields shared by every GL entry made against this repair,
+		# built once so getdate() is not re-evaluated per entry
+		return {
+			"voucher_type": self.doctype,
+			"voucher_no": self.name,
+			"cost_center": self.cost_center,
+			"posting_date": getdate(),
+			"company": self.company,
+		}
+
 	def get_gl_entries_for_consumed_items(self, gl_entries, fixed_asset_account):
 		if not (self.get("stock_consumption") and self.get("stock_items")):
 			return
 
 		# creating GL Entries for each row in Stock Items based on the Stock Entry created for it
-		stock_entry = frappe.get_doc("Stock Entry", self.stock_entry)
+		stock_entry_items = frappe.get_all(
+			"Stock Entry Detail",
+			filters={"parent": self.stock_entry},
+			fields=["amount", "expense_account"],
+			order_by="idx",
+		)
 
 		default_expense_account = None
 		if not erpnext.is_perpetual_inventory_enabled(self.company):
@@ -277,20 +357,20 @@ class AssetRepair(AccountsController):
 			if not default_expense_account:
 				frappe.throw(_("Please set default Expense Account in Company {0}").format(self.company))
 
-		for item in stock_entry.items:
+		base_gl_entry = self.get_base_gl_entry_fields()
+
+		for item in stock_entry_items:
 			if flt(item.amount) > 0:
+				expense_account = item.expense_account or default_expense_account
+
 				gl_entries.append(
 					self.get_gl_dict(
 						{
-							"account": item.expense_account or default_expense_account,
+							**base_gl_entry,
+							"account": expense_account,
 							"credit": item.amount,
 							"credit_in_account_currency": item.amount,
 							"against": fixed_asset_account,
-							"voucher_type": self.doctype,
-							"voucher_no": self.name,
-							"cost_center": self.cost_center,
-							"posting_date": getdate(),
-							"company": self.company,
 						},
 						item=self,
 					)
@@ -299,28 +379,33 @@ class AssetRepair(AccountsController):
 				gl_entries.append(
 					self.get_gl_dict(
 						{
+							**base_gl_entry,
 							"account": fixed_asset_account,
 							"debit": item.amount,
 							"debit_in_account_currency": item.amount,
-							"against": item.expense_account or default_expense_account,
-							"voucher_type": self.doctype,
-							"voucher_no": self.name,
-							"cost_center": self.cost_center,
-							"posting_date": getdate(),
+							"against": expense_account,
 							"against_voucher_type": "Stock Entry",
 							"against_voucher": self.stock_entry,
-							"company": self.company,
 						},
 						item=self,
 					)
 				)
 
 	def modify_depreciation_schedule(self):
+		if not self.increase_in_asset_life:
+			return
+
+		increase_in_asset_life = self.increase_in_asset_life
+
 		for row in self.asset_doc.finance_books:
-			row.total_number_of_depreciations += self.increase_in_asset_life / row.frequency_of_depreciation
+			frequency_of_depreciation = row.frequency_of_depreciation
+
+			row.total_number_of_depreciations = (
+				cint(row.total_number_of_depreciations) + increase_in_asset_life // frequency_of_depreciation
+			)
 
 			self.asset_doc.flags.increase_in_asset_life = False
-			extra_months = self.increase_in_asset_life % row.frequency_of_depreciation
+			extra_months = increase_in_asset_life % frequency_of_depreciation
 			if extra_months != 0:
 				self.calculate_last_schedule_date(self.asset_doc, row, extra_months)
 
@@ -331,10 +416,10 @@ class AssetRepair(AccountsController):
 			asset.number_of_depreciations_booked
 		)
 
-		depr_schedule = get_depr_schedule(asset.name, "Active", row.finance_book)
+		depr_schedule = self.get_active_depr_schedule_doc(row.finance_book).get("depreciation_schedule")
 
 		# the Schedule Date in the final row of the old Depreciation Schedule
-		last_schedule_date = depr_schedule[len(depr_schedule) - 1].schedule_date
+		last_schedule_date = depr_schedule[-1].schedule_date
 
 		# the Schedule Date in the final row of the new Depreciation Schedule
 		asset.to_date = add_months(last_schedule_date, extra_months)
@@ -350,11 +435,20 @@ class AssetRepair(AccountsController):
 			row.total_number_of_depreciations += 1
 
 	def revert_depreciation_schedule_on_cancellation(self):
+		if not self.increase_in_asset_life:
+			return
+
+		increase_in_asset_life = self.increase_in_asset_life
+
 		for row in self.asset_doc.finance_books:
-			row.total_number_of_depreciations -= self.increase_in_asset_life / row.frequency_of_depreciation
+			frequency_of_depreciation = row.frequency_of_depreciation
+
+			row.total_number_of_depreciations = (
+				cint(row.total_number_of_depreciations) - increase_in_asset_life // frequency_of_depreciation
+			)
 
 			self.asset_doc.flags.increase_in_asset_life = False
-			extra_months = self.increase_in_asset_life % row.frequency_of_depreciation
+			extra_months = increase_in_asset_life % frequency_of_depreciation
 			if extra_months != 0:
 				self.calculate_last_schedule_date_before_modification(self.asset_doc, row, extra_months)
 
@@ -364,10 +458,10 @@ class AssetRepair(AccountsController):
 			asset.number_of_depreciations_booked
 		)
 
-		depr_schedule = get_depr_schedule(asset.name, "Active", row.finance_book)
+		depr_schedule = self.get_active_depr_schedule_doc(row.finance_book).get("depreciation_schedule")
 
 		# the Schedule Date in the final row of the modified Depreciation Schedule
-		last_schedule_date = depr_schedule[len(depr_schedule) - 1].schedule_date
+		last_schedule_date = depr_schedule[-1].schedule_date
 
 		# the Schedule Date in the final row of the original Depreciation Schedule
 		asset.to_date = add_months(last_schedule_date, -extra_months)
@@ -385,5 +479,7 @@ class AssetRepair(AccountsController):
 
 @frappe.whitelist()
 def get_downtime(failure_date, completion_date):
-	downtime = time_diff_in_hours(completion_date, failure_date)
+	# called from the client on every datetime field change, so subtract
+	# the parsed datetimes directly instead of going through time_diff_in_hours
+	downtime = (get_datetime(completion_date) - get_datetime(failure_date)).total_seconds() / 3600
 	return round(downtime, 2)
@@ -2,8 +2,13 @@
 # For license information, please see license.txt
 
 
+import frappe
 from frappe.model.document import Document
 
 
 class DepreciationSchedule(Document):
 	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Depreciation Schedule", ["parent", "idx"])